@@ -20,38 +20,52 @@ Get the monthly usage for the given users on the given clusters
 """
 
 import os
-import re
+import subprocess
 import sys
+import tempfile
 import yaml
 
-from collections import namedtuple
-from ConfigParser import ConfigParser
-from itertools import dropwhile
 from time import strftime, strptime
-from copy import deepcopy
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 from vsc.utils.mail import VscMail
-from vsc.utils.run import run
 from vsc.utils.script_tools import CLI
 from vsc.config.base import GENT_PRODUCTION_COMPUTE_CLUSTERS
 
 
-SREPORT_TEMPLATE = "sreport --cluster={cluster} -T cpu,gres/gpu cluster UserUtilizationByAccount start={startdate} end={enddate} -t Hours --parsable2"
-
-UsageInfo = namedtuple("UsageInfo", ["cpu", "gpu"])
+SREPORT_TEMPLATE = [
+    "sreport",
+    "--cluster", "{clusters}",
+    "-T", "cpu,gres/gpu",
+    "cluster", "UserUtilizationByAccount",
+    "start={startdate}",
+    "end={enddate}",
+    "-t", "Hours",
+    "--parsable2",
+]
 
 import logging
 
 
+def is_separator(line):
+    """Is the given line a non-empty line made up solely of dashes?"""
+    return bool(line) and not line.strip('-')
+
+
 def usage_info_to_string(usage):
-    return "cpu:%d:gpu:%d" % (usage.cpu, usage.gpu)
+    """Format a (cpu, gpu) usage tuple"""
+    return "cpu:%d:gpu:%d" % usage
 
 class UsageReport(CLI):
 
 
     CLI_OPTIONS = {
         'userfile': ("File containing the groups of usernames to request info for (yaml format)", None, "store", None),
-        'cluster': ("Cluster to get information for", None, "store", None),
+        'cluster': ("Cluster(s) to get information for (comma-separated)", None, "store", None),
         'recipient': ("email address of the person requiring the info", None, "store", None),
         'start': ("Start of time period for which to report (DD/MM/YYYY)", None, "store", None),
         'end': ("End of time period for which to report (DD/MM/YYYY)", None, "store", None),
@@ -60,7 +74,13 @@ class UsageReport(CLI):
     def load_users(self):
         """Get a set of users from the given yaml file"""
         with open(self.options.userfile, "r") as userfile:
-            self.users = yaml.load(userfile, Loader=yaml.Loader)  # Should be FullLoader to address CVE-2017-18342
+            self.users = yaml.load(userfile, Loader=YamlLoader)
+
+        # map each user to the companies it belongs to, so usage can be dispatched in a single pass
+        self.companies = {}
+        for (company, company_users) in self.users.items():
+            for user in company_users:
+                self.companies.setdefault(user, []).append(company)
 
         logging.debug("Checking for users: %s", self.users)
 
@@ -69,62 +89,81 @@ class UsageReport(CLI):
         return strftime("%M/%d/%y", strptime(date, "%d/%M/%Y"))
 
     def process(self, output):
-        """Convert the output of the sreport command into a list."""
-        lines = output.splitlines()
+        """Convert the output lines of the sreport command into a dict."""
+        lines = (line.rstrip('\n') for line in output)
 
         # The useful data occurs after the second line of dashes
-        sep = re.compile(r'^--*$')
-        drop = lambda ls, f: list(dropwhile(lambda l: not(f(l)), ls))[1:]
-        lines = drop(lines, lambda l: sep.match(l))
-        lines = drop(lines, lambda l: sep.match(l))
+        separators = 0
+        for line in lines:
+            if is_separator(line):
+                separators += 1
+                if separators == 2:
+                    break
+        else:
+            raise ValueError("Could not find the sreport banner in the output")
 
         # The first line now contains the column headers
-        headers = lines[0].split('|')
-        lines = lines[1:]
+        if next(lines, None) is None:
+            raise ValueError("Could not find the sreport column headers in the output")
 
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
         user_info = {}
         # we have two xRES lines per user, so we should process them together
-        for i in range(0, len(lines)/2):
-            cpu_line = lines[2*i].split('|')
-            gpu_line = lines[2*i+1].split('|')
-
-            user = cpu_line[1]  # login
-            cpu_usage = int(cpu_line[-1])
-            gpu_usage = int(gpu_line[-1])
+        for (cpu_line, gpu_line) in zip(lines, lines):
+            (cluster, user, _) = cpu_line.split('|', 2)  # cluster, login, ...
+            cpu_usage = int(cpu_line.rsplit('|', 1)[1])
+            gpu_usage = int(gpu_line.rsplit('|', 1)[1])
 
-            user_info[user] = UsageInfo(cpu=cpu_usage, gpu=gpu_usage)
-            logging.debug("Adding user %s info %d %d", user, cpu_usage, gpu_usage)
+            user_info[(cluster, user)] = (cpu_usage, gpu_usage)
+            if debug:
+                logging.debug("Adding user %s on cluster %s info %d %d", user, cluster, cpu_usage, gpu_usage)
 
         return user_info
 
-    def report(self, cluster):
-        """Make a report for the given cluster"""
-
-        logging.debug("Start date: %s", self.convert_date(self.options.start))
-        logging.debug("End date: %s", self.convert_date(self.options.end))
-
-        sreport_command = SREPORT_TEMPLATE.format(
-            cluster=cluster,
-            startdate=self.convert_date(self.options.start),
-            enddate=self.convert_date(self.options.end)
-        )
-
-        ec, output = run(sreport_command)
-
-        logging.info("Report command ran, ec = %d", ec)
-
-        info = self.process(output)
+    def report(self, clusters, startdate, enddate):
+        """Make a report for the given clusters and (converted) dates, using a single sreport invocation"""
+
+        fields = {
+            'clusters': ",".join(clusters),
+            'startdate': startdate,
+            'enddate': enddate,
+        }
+        sreport_command = [arg.format(**fields) for arg in SREPORT_TEMPLATE]
+
+        # stderr goes to a file rather than a second pipe, so sreport cannot block on it while we parse stdout
+        with tempfile.TemporaryFile(mode="w+") as errors:
+            proc = subprocess.Popen(sreport_command, stdout=subprocess.PIPE, stderr=errors, universal_newlines=True)
+            try:
+                info = self.process(proc.stdout)
+            finally:
+                # drain whatever parsing left behind, so sreport cannot hang on a full pipe and exits on its own
+                for _ in proc.stdout:
+                    pass
+                proc.stdout.close()
+                ec = proc.wait()
+                logging.info("Report command ran, ec = %d", ec)
+                errors.seek(0)
+                error_output = errors.read().strip()
+                if ec != 0:
+                    # a failing sreport is the root cause of any parse error, so report that instead
+                    raise RuntimeError("sreport failed with exit code %d: %s" % (ec, error_output))
+                if error_output:
+                    logging.warning("Report command stderr: %s", error_output)
 
         relevant_info = {}
-        for (company, users) in self.users.items():
-            relevant_info[company] = dict(
-                filter(lambda kv: kv[0] in users, info.items())
-            )
+        for ((cluster, user), usage) in info.items():
+            for company in self.companies.get(user, ()):
+                relevant_info.setdefault(cluster, {}).setdefault(company, {})[user] = usage
+
+        # keep the requested cluster order, followed by anything else sreport returned
+        ordered_clusters = [c for c in clusters if c in relevant_info]
+        ordered_clusters += sorted(set(relevant_info) - set(clusters))
 
         body = []
-        for (company, users) in sorted(relevant_info.items()):
-            for (user, usage) in sorted(users.items()):
-                body += ["%s:%s:%s:%s" % (cluster, company, user, usage_info_to_string(usage))]
+        for cluster in ordered_clusters:
+            for (company, users) in sorted(relevant_info[cluster].items()):
+                for (user, usage) in sorted(users.items()):
+                    body += ["%s:%s:%s:%s" % (cluster, company, user, usage_info_to_string(usage))]
         return body
 
     def do(self, dry_run):
@@ -132,13 +171,18 @@ class UsageReport(CLI):
 
         clusters = GENT_PRODUCTION_COMPUTE_CLUSTERS
         if self.options.cluster:
-            clusters = (self.options.cluster,)
+            clusters = tuple(self.options.cluster.split(','))
 
         self.load_users()
 
-        body = []
-        for cluster in clusters:
-            body += self.report(cluster)
+        startdate = self.convert_date(self.options.start)
+        enddate = self.convert_date(self.options.end)
+        logging.debug("Start date: %s", startdate)
+        logging.debug("End date: %s", enddate)
+
+        body = self.report(clusters, startdate, enddate)
+        if not body:
+            logging.warning("No usage found for the given users on clusters %s", ",".join(clusters))
 
         mail_body = "\n".join(body)
         mail_subject = "HPC: usage report %s - %s" % (self.options.start, self.options.end)